@@ -23,34 +23,55 @@
 
 """
 import os
-import csv
+import calendar
+import collections
+import contextlib
+import functools
+import json
 import random
-import socket
-import struct
-from datetime import datetime, timedelta
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
 
 from rua import generate_report, validate_report
 
+# IPv4 to country data and a JSON copy of the parsed data, used to skip
+# parsing the csv file on subsequent runs
+IP_DATA_NAME = "ipv4_to_country.csv"
+IP_DATA_CACHE_NAME = "ipv4_to_country.json"
+# Version of the structure of the cached data, a cache with another version is
+# re-created
+IP_DATA_CACHE_VERSION = 3
 
-def get_report_days(start_day, num_days):
-  """Get a list of `num_days` days starting at `start_day`. """
-  return [start_day + timedelta(days=i) for i in range(0, num_days)]
+# Reports are always generated in the same way, set DMARC_VALIDATE=0 in the
+# environment to skip validating each of them against the schema
+VALIDATE = os.environ.get("DMARC_VALIDATE", "1") == "1"
 
+# Set DMARC_ARCHIVE=1 in the environment to write reports to one compressed
+# zip archive per output dir, i.e. `<dir>.zip`, instead of one file per report
+ARCHIVE = os.environ.get("DMARC_ARCHIVE", "0") == "1"
 
-def get_report_metadata(reporter, reportee, day, **kw):
+
+def get_report_day_timestamps(start_ts, num_days):
+  """Get unix timestamps for the begin of `num_days` days starting at
+  `start_ts`. """
+  return range(start_ts, start_ts + num_days * 86400, 86400)
+
+
+def get_report_metadata(reporter, reportee, begin):
   """Return "report_metadata" part using passed `reporter` and `reportee`
-  domain and `day` for which the report aggregates results. """
-  # Get unix timestamp for begin of day
-  begin = int(day.date().strftime("%s"))
+  domain and unix timestamp for the `begin` of the day for which the report
+  aggregates results. """
   # Get unix timestamp for end of day, i.e. being + 1 day - 1 second
   end = begin + 86400 - 1
 
   return {
     "org_name": reporter,
-    "org_email": "postmaster@{domain}".format(domain=reporter),
-    "extra_contact_info": "www.{domain}".format(domain=reporter),
+    "org_email": f"postmaster@{reporter}",
+    "extra_contact_info": f"www.{reporter}",
     # "<report receiver domain>:<non-leap seconds since epoch>"
-    "report_id": "{reportee}:{ts}".format(reportee=reportee, ts=end),
+    "report_id": f"{reportee}:{end}",
     # The time range in UTC covered by messages in this report,
     # specified in seconds since epoch
     "date_range": {
@@ -60,9 +81,12 @@ def get_report_metadata(reporter, reportee, day, **kw):
   }
 
 
-def get_policy_published(reportee, policy, **kw):
+@functools.lru_cache(maxsize=None)
+def get_policy_published(reportee, policy):
   """Return "policy_published" part for a passed `reportee` and `policy`. For
-  now we use the hardcoded values for `adkim`, `aspf` and `pct` everywhere. """
+  now we use the hardcoded values for `adkim`, `aspf` and `pct` everywhere.
+  The part is the same for all reports of a report exchange, hence it is
+  created once and shared, i.e. it must not be modified. """
   return {
     "domain": reportee,
     "adkim": "r",
@@ -73,10 +97,9 @@ def get_policy_published(reportee, policy, **kw):
   }
 
 
-def get_row(reportee, policy, dkim_result, spf_result, message_count,
-      source_ip, **kw):
-  """Return "row" part based on `reportee`, `policy`, `dkim_result` and
-  `spf_result`, `message_count` and `source_ip`. See inline comments for more
+def get_row(policy, dkim_result, spf_result, message_count, source_ip):
+  """Return "row" part based on `policy`, `dkim_result` and `spf_result`,
+  `message_count` and `source_ip`. See inline comments for more
   information on how some of the values are populated. """
   # Aligned DKIM and SPF result can only "pass" if one  of the corresponding
   # raw results passes. However, even if a raw result "passes" the aligned
@@ -105,16 +128,18 @@ def get_row(reportee, policy, dkim_result, spf_result, message_count,
   }
 
 
-def get_identifiers(reporter, reportee, **kw):
+@functools.lru_cache(maxsize=None)
+def get_identifiers(reporter, reportee):
   """Return "identifiers" part. For now, the `envelope_to` field always
   corresponds to the `reporter`, i.e. mail receiver and the `header_from` to
-  the `reportee`, i.e. purported mail sender. """
+  the `reportee`, i.e. purported mail sender. Like "policy_published", the
+  part is created once per report exchange and shared. """
   return {
     "envelope_to": reporter,
     "header_from": reportee
   }
 
-def get_auth_results(reportee, dkim_result, spf_result, **kw):
+def get_auth_results(reportee, dkim_result, spf_result):
   """Return "auth_results" part. This can be no or more raw DKIM results and
   one or more SPF results. For now we always return either no or one DKIM and
   one SPF result, based on the passed `dkim_result` and `spf_result` and use
@@ -137,41 +162,187 @@ def get_auth_results(reportee, dkim_result, spf_result, **kw):
   }
 
 
-def get_record(**kw):
-  """Return "record" part. A report can have multiple records, each record
-  aggregates over a mail sender IP and an evaluated policy. For now we generate
-  one record per report. """
+def get_record(report_vars):
+  """Return "record" part using the variables in the passed `report_vars`
+  dictionary. A report can have multiple records, each record aggregates over a
+  mail sender IP and an evaluated policy. For now we generate one record per
+  report. """
+  reporter = report_vars["reporter"]
+  reportee = report_vars["reportee"]
+  dkim_result = report_vars["dkim_result"]
+  spf_result = report_vars["spf_result"]
+
   return {
-    "row": get_row(**kw),
-    "identifiers": get_identifiers(**kw),
-    "auth_results": get_auth_results(**kw),
+    "row": get_row(report_vars["policy"], dkim_result, spf_result,
+        report_vars["message_count"], report_vars["source_ip"]),
+    "identifiers": get_identifiers(reporter, reportee),
+    "auth_results": get_auth_results(reportee, dkim_result, spf_result),
   }
 
 
-def get_report_data(**kw):
-  """Get report data for a single report. """
+def get_report_data(report_vars):
+  """Get report data for a single report using the variables in the passed
+  `report_vars` dictionary. """
+  reporter = report_vars["reporter"]
+  reportee = report_vars["reportee"]
+
   return {
-    "report_metadata": get_report_metadata(**kw),
-    "policy_published": get_policy_published(**kw),
-    "records": [get_record(**kw)]
+    "report_metadata": get_report_metadata(reporter, reportee,
+        report_vars["begin"]),
+    "policy_published": get_policy_published(reportee, report_vars["policy"]),
+    "records": [get_record(report_vars)]
   }
 
 
-def get_country_to_ip_dict():
+def _ip_number_to_string(ip_number):
+  """Return passed IPv4 `ip_number` as dotted-quad string. """
+  return (f"{(ip_number >> 24) & 0xFF}.{(ip_number >> 16) & 0xFF}."
+      f"{(ip_number >> 8) & 0xFF}.{ip_number & 0xFF}")
+
+
+def get_country_ip_table():
   """Read IPv4 csv file with two columns "IP number" and "two letter country
-  code", and create a dictionary with country codes as keys and IP addresses as
-  values. """
-  ip_to_country_dict = {}
-  with open("ipv4_to_country.csv") as fp:
-    csv_reader = csv.reader(fp, delimiter=",")
-    for row in csv_reader:
-      # Ignore empty and commented lines
-      if len(row) and not row[0].startswith("#"):
-        # Convert IP number to string
-        ip_string = socket.inet_ntoa(struct.pack('!L', int(row[0])))
-        ip_to_country_dict[row[1]] = ip_string
+  code", and return a tuple of a tuple of country codes, a tuple of the
+  corresponding IP addresses, i.e. one per country, and a dictionary with
+  country codes as keys and their index in the former tuples as values. """
+  with open(IP_DATA_NAME) as fp:
+    # Ignore empty and commented lines. The values contain no commas or
+    # escaped quotes, so instead of using the csv module we just drop the
+    # enclosing quotes and split each line at the comma.
+    rows = (line.replace('"', "").split(",", 1) for line in fp
+        if not line.startswith("#") and not line.isspace())
+
+    # Convert IP numbers to dotted-quad strings in a single pass, later rows
+    # overwrite earlier rows with the same country code
+    country_to_ip = {row[1].rstrip(): _ip_number_to_string(int(row[0]))
+        for row in rows}
+
+  countries = tuple(country_to_ip.keys())
+  ips = tuple(country_to_ip.values())
+  country_index = {country: i for i, country in enumerate(countries)}
+
+  return countries, ips, country_index
+
+
+def get_cached_country_ip_table():
+  """Return the data created by `get_country_ip_table` from a JSON cache
+  file, if the cache was created for the current version of the csv file, i.e.
+  matches its modification time and size, and the current cache version.
+  Otherwise parse the csv file and (re-)create the cache. """
+  ip_data_stat = os.stat(IP_DATA_NAME)
+  cache_key = [IP_DATA_CACHE_VERSION, ip_data_stat.st_mtime,
+      ip_data_stat.st_size]
+
+  # Use JSON rather than pickle, so that loading a planted or corrupted cache
+  # file can't execute code. The country index is cheap to derive again.
+  try:
+    with open(IP_DATA_CACHE_NAME, "rb") as fp:
+      cache = json.load(fp)
+
+    if cache["key"] == cache_key:
+      countries = tuple(cache["countries"])
+      ips = tuple(cache["ips"])
+      if len(countries) == len(ips):
+        return countries, ips, {
+            country: i for i, country in enumerate(countries)}
+
+  # Missing, outdated or corrupted cache, fall through and re-create it
+  except (OSError, ValueError, TypeError, KeyError):
+    pass
+
+  ip_data = get_country_ip_table()
+  countries, ips, _ = ip_data
+
+  # Write to a unique temporary file and rename, so that concurrent runs
+  # neither read a partially written cache nor write to the same file. A
+  # failure to write the cache is harmless, it is just re-created next time.
+  fd, tmp_cache_name = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(IP_DATA_CACHE_NAME)))
+  try:
+    with os.fdopen(fd, "w") as fp:
+      json.dump({"key": cache_key, "countries": countries, "ips": ips}, fp)
+    os.replace(tmp_cache_name, IP_DATA_CACHE_NAME)
+
+  except OSError:
+    with contextlib.suppress(OSError):
+      os.remove(tmp_cache_name)
+
+  return ip_data
+
+
+def _generate_report(task):
+  """Generate a single report and return a tuple of the path prefix to write
+  it to, its name, using the typical name format, and the report. `task` is a
+  tuple of the path prefix, i.e. directory and trailing separator, to write
+  the report to and the variables passed to `get_report_data`. """
+  path_prefix, report_vars = task
+
+  # Genrate report data
+  report_data = get_report_data(report_vars)
+
+  # Generate DMARC compliant report
+  report_xml_string, report_name = generate_report(report_data)
+
+  return path_prefix, report_name, report_xml_string
+
+
+def _validate_report(report):
+  """Validate report schema of passed `report`, i.e. a tuple as returned by
+  `_generate_report`, unless validation is disabled, and return it. """
+  if VALIDATE:
+    validate_report(report[2])
+
+  return report
+
+
+def _write_file(report):
+  """Validate passed `report`, i.e. a tuple as returned by `_generate_report`,
+  and write it to a file. """
+  path_prefix, report_name, report_xml_string = _validate_report(report)
+  with open(path_prefix + report_name, "wb") as fp:
+    fp.write(report_xml_string)
+
+
+def _write_files(reports, thread_executor):
+  """Validate and write passed `reports`, i.e. tuples as returned by
+  `_generate_report`, to one file each on passed `thread_executor`. """
+  write_futures = [thread_executor.submit(_write_file, report)
+      for report in reports]
+
+  # Re-raise errors from validating or writing files, if any
+  for write_future in write_futures:
+    write_future.result()
+
+
+def _validate_reports(reports, thread_executor):
+  """Validate passed `reports`, i.e. tuples as returned by `_generate_report`,
+  on passed `thread_executor` and yield them in order. Other than
+  `Executor.map`, each report is submitted as soon as it is generated, and
+  validated reports are yielded while more reports are generated. """
+  validate_futures = collections.deque()
+  for report in reports:
+    validate_futures.append(thread_executor.submit(_validate_report, report))
+    while validate_futures and validate_futures[0].done():
+      yield validate_futures.popleft().result()
+
+  while validate_futures:
+    yield validate_futures.popleft().result()
+
+
+def _write_archives(reports, thread_executor):
+  """Validate passed `reports`, i.e. tuples as returned by `_generate_report`,
+  on passed `thread_executor` and write them to one zip archive per path
+  prefix, named after the prefix's directory. """
+  with contextlib.ExitStack() as stack:
+    archives = {}
+    for path_prefix, report_name, report_xml_string in _validate_reports(
+        reports, thread_executor):
+      if path_prefix not in archives:
+        archive_path = path_prefix[:-len(os.sep)] + ".zip"
+        archives[path_prefix] = stack.enter_context(
+            zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED))
 
-  return ip_to_country_dict
+      archives[path_prefix].writestr(report_name, report_xml_string)
 
 
 def main():
@@ -185,15 +356,16 @@ def main():
   incoming_path = os.path.join(base_path, "incoming")
   outgoing_path = os.path.join(base_path, "outgoing")
 
-  # Create output dirs if not there
-  if not os.path.exists(incoming_path):
-    os.makedirs(incoming_path)
+  # Create output dirs if not there, archives are stored in the base dir
+  if ARCHIVE:
+    os.makedirs(base_path, exist_ok=True)
 
-  if not os.path.exists(outgoing_path):
-    os.makedirs(outgoing_path)
+  else:
+    os.makedirs(incoming_path, exist_ok=True)
+    os.makedirs(outgoing_path, exist_ok=True)
 
-  # Load IP data from csv
-  ip_data = get_country_to_ip_dict()
+  # Load IP data from csv (or its cache)
+  _, ips, country_index = get_cached_country_ip_table()
 
   # Available raw DKIM and SPF results to choose from randomly. A DKIM result
   # of type `None` means that the report has no raw DKIM result.
@@ -203,7 +375,7 @@ def main():
       "temperror", "permerror"]
 
   # Time range to create reports for
-  start_day = datetime(2017, 1, 1)
+  start_ts = calendar.timegm(datetime(2017, 1, 1).timetuple())
   num_days = 365
 
   # Bounds for random message count
@@ -244,44 +416,60 @@ def main():
     }
   ]
 
+  # Collect variables for all reports in the parent process, so that the
+  # seeded random values don't depend on how work is distributed to workers
+  tasks = []
+
   # Iterate over 3 sets of basic report data one for incoming and one for
   # outgoing reports ...
   for report_vars in report_vars_list:
-    # ... create a report for each day using random values
-    for day in get_report_days(start_day, num_days):
-      report_vars["day"] = day
+    # Randomly choose raw dkim and spf results and message counts for all days
+    # at once
+    dkim_results = random.choices(dkim_result_choices, k=num_days)
+    spf_results = random.choices(spf_result_choices, k=num_days)
+    message_counts = random.choices(
+        range(message_count_min, message_count_max + 1), k=num_days)
+    # ... and sender IP addresses, which are used if SPF does not pass
+    random_ips = random.choices(ips, k=num_days)
+
+    # Store incoming and outgoing reports to different dirs, the prefix is
+    # joined with each report name by plain string concatenation
+    path_prefix = (outgoing_path
+        if report_vars["reporter"] == my_domain else incoming_path) + os.sep
+
+    # Use tld of reportee domain to choose a legitimate email
+    country_code = report_vars["reportee"].rsplit(".", 1)[1].upper()
+    legitimate_ip = ips[country_index[country_code]]
 
-      # Randomly choose raw dkim and spf result and message count
-      report_vars["dkim_result"] = random.choice(dkim_result_choices)
-      report_vars["spf_result"] = random.choice(spf_result_choices)
-      report_vars["message_count"] = random.randint(message_count_min,
-          message_count_max)
+    # ... create a report for each day using random values
+    for begin, dkim_result, spf_result, message_count, random_ip in zip(
+        get_report_day_timestamps(start_ts, num_days), dkim_results,
+        spf_results, message_counts, random_ips):
+      day_vars = dict(report_vars, begin=begin, dkim_result=dkim_result,
+          spf_result=spf_result, message_count=message_count)
 
       # Assign IP address based on SPF result
-      if report_vars["spf_result"] == "pass":
-        # Use tld of reportee domain to choose a legitimate email
-        country_code = report_vars["reportee"].split(".")[-1].upper()
-        report_vars["source_ip"] = ip_data[country_code]
+      if spf_result == "pass":
+        day_vars["source_ip"] = legitimate_ip
 
       else:
-        report_vars["source_ip"] = random.choice(ip_data.values())
-
-      # Genrate report data
-      report_data = get_report_data(**report_vars)
+        day_vars["source_ip"] = random_ip
 
-      # Generate DMARC compliant report
-      report_xml_string, report_name = generate_report(report_data)
+      tasks.append((path_prefix, day_vars))
 
-      # Validate report schema
-      validate_report(report_xml_string)
+  # Reports are independent of each other, generate them on all CPUs and,
+  # while waiting for more reports, validate and store them on a thread pool.
+  # lxml releases the GIL while parsing and validating, so the threads run in
+  # parallel and share the compiled schema.
+  with ProcessPoolExecutor() as executor, \
+      ThreadPoolExecutor(max_workers=4) as thread_executor:
+    reports = executor.map(_generate_report, tasks, chunksize=32)
 
-      # Store incoming and outgoing reports to different dirs
-      base_path = (outgoing_path
-          if report_vars["reporter"] == my_domain else incoming_path)
+    if ARCHIVE:
+      _write_archives(reports, thread_executor)
 
-      # Write report to file
-      with open(os.path.join(base_path, report_name), "w") as fp:
-        fp.write(report_xml_string)
+    else:
+      _write_files(reports, thread_executor)
 
 
 if __name__ == "__main__":
@@ -30,39 +30,226 @@
   validate_report(report)
 
   # Write to file using the typical filename format
-  with open(report_name, "w") as f: f.write(report)
+  with open(report_name, "wb") as f: f.write(report)
   ```
 
 """
+import io
+import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
 from lxml import etree
-from jinja2 import FileSystemLoader, Environment
 
 # Filename constants
-REPORT_TEMPLATE_DIR = "."
-REPORT_TEMPLATE_NAME = "rua.xml.j2"
 REPORT_SCHEMA_NAME = "rua.xsd"
 
-# Prepare DMARC aggregate report template
-LOADER = FileSystemLoader(REPORT_TEMPLATE_DIR)
-ENV = Environment(loader=LOADER, trim_blocks=True, lstrip_blocks=True)
-REPORT_TEMPLATE = ENV.get_template(REPORT_TEMPLATE_NAME)
 
-# Prepare DMARC aggregate report schema
-with open(REPORT_SCHEMA_NAME, "r") as f:
-  schema_data = f.read()
-REPORT_SCHEMA = schema_data
+# Options for XML parsers that neither load DTDs nor access the network nor
+# lift libxml2's size limits. External entities are never resolved (lxml >= 5
+# only resolves internal entities).
+SAFE_PARSER_OPTIONS = {
+  "no_network": True,
+  "load_dtd": False,
+  "huge_tree": False,
+}
+
+# Serialized reports larger than this (in bytes) are validated incrementally
+# while parsing, which bounds memory use to about one record, but is slower
+# than parsing the whole report and then validating it
+INCREMENTAL_VALIDATION_MIN_SIZE = 1024 * 1024
+
+
+def _get_safe_parser():
+  """Return a new XML parser with SAFE_PARSER_OPTIONS. A new parser is created
+  per use (cheap), because lxml serializes concurrent use of a shared parser
+  and reports are validated from multiple threads. """
+  return etree.XMLParser(**SAFE_PARSER_OPTIONS)
+
 
-# Define typical filename format for DMARC aggregate reports
+# Prepare DMARC aggregate report schema, compiled once and reused for every
+# report validation
+with open(REPORT_SCHEMA_NAME, "rb") as f:
+  REPORT_SCHEMA = etree.XMLSchema(etree.parse(f, _get_safe_parser()))
+
+# Define typical filename format for DMARC aggregate reports (for reference,
+# `_format_report_filename` inlines it as f-string)
 REPORT_FILENAME_FORMAT = "{org_name}!{domain}!{begin}!{end}.xml"
 
+# Define DMARC aggregate report string templates used by `generate_report`
+# and `write_report`, i.e. the report header, one record template per record
+# and the footer. Optional elements are rendered from the "OPTIONAL" templates
+# below, or left out. All values are XML-escaped before they are inserted.
+# NOTE: The rendered report must be byte-identical to the pretty-printed
+# serialization of the same report by lxml, including which optional and
+# empty elements are left out. `test_rua.py` checks this.
+REPORT_HEADER_FORMAT = """<?xml version='1.0' encoding='utf-8'?>
+<feedback>
+  <report_metadata>
+    <org_name>{org_name}</org_name>
+    <email>{org_email}</email>
+{extra_contact_info}    <report_id>{report_id}</report_id>
+    <date_range>
+      <begin>{begin}</begin>
+      <end>{end}</end>
+    </date_range>
+{errors}  </report_metadata>
+  <policy_published>
+    <domain>{domain}</domain>
+{adkim}{aspf}    <p>{p}</p>
+    <sp>{sp}</sp>
+    <pct>{pct}</pct>
+  </policy_published>
+"""
+REPORT_RECORD_FORMAT = """  <record>
+    <row>
+      <source_ip>{source_ip}</source_ip>
+      <count>{count}</count>
+      <policy_evaluated>
+        <disposition>{disposition}</disposition>
+        <dkim>{dkim}</dkim>
+        <spf>{spf}</spf>
+{reasons}      </policy_evaluated>
+    </row>
+    <identifiers>
+{envelope_to}      <header_from>{header_from}</header_from>
+    </identifiers>
+    <auth_results>
+{dkim_results}{spf_results}    </auth_results>
+  </record>
+"""
+REPORT_FOOTER = "</feedback>\n"
+
+REPORT_OPTIONAL_FORMATS = {
+  "extra_contact_info":
+      "    <extra_contact_info>{}</extra_contact_info>\n",
+  "error": "    <error>{}</error>\n",
+  "adkim": "    <adkim>{}</adkim>\n",
+  "aspf": "    <aspf>{}</aspf>\n",
+  "reason": "        <reason>\n"
+      "          <type>{type}</type>\n"
+      "{comment}"
+      "        </reason>\n",
+  "comment": "          <comment>{}</comment>\n",
+  "envelope_to": "      <envelope_to>{}</envelope_to>\n",
+  "dkim_result": "      <dkim>\n"
+      "        <domain>{domain}</domain>\n"
+      "        <result>{result}</result>\n"
+      "{human_result}"
+      "      </dkim>\n",
+  "human_result": "        <human_result>{}</human_result>\n",
+  "spf_result": "      <spf>\n"
+      "        <domain>{domain}</domain>\n"
+      "        <result>{result}</result>\n"
+      "      </spf>\n",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_report_filename(org_name, domain, begin, end):
+  """Return report filename in the REPORT_FILENAME_FORMAT. Memoized, as the
+  same report metadata is often used for many reports, e.g. in tests. """
+  return f"{org_name}!{domain}!{begin}!{end}.xml"
+
 
 def _get_report_filename_from_context(context):
   """Generate report filename from context used with `generate_report`.  """
-  return REPORT_FILENAME_FORMAT.format(
-      org_name=context["report_metadata"]["org_name"],
-      domain=context["policy_published"]["domain"],
-      begin=context["report_metadata"]["date_range"]["begin"],
-      end=context["report_metadata"]["date_range"]["end"])
+  report_metadata = context["report_metadata"]
+  date_range = report_metadata["date_range"]
+  return _format_report_filename(report_metadata["org_name"],
+      context["policy_published"]["domain"], date_range["begin"],
+      date_range["end"])
+
+
+def _escape(value):
+  """Return passed `value` as string, XML-escaped for use as element text,
+  like lxml does, i.e. also replacing carriage returns. """
+  value = str(value)
+  # Most values (IPs, domains, counts) need no escaping, and the membership
+  # tests are cheaper than calling `escape`, which replaces unconditionally
+  if "&" in value or "<" in value or ">" in value or "\r" in value:
+    return escape(value, {"\r": "&#13;"})
+
+  return value
+
+
+def _render_optional(name, value):
+  """Return optional element from REPORT_OPTIONAL_FORMATS with passed `name`,
+  containing passed `value`, or an empty string if there is no value. """
+  if not value:
+    return ""
+
+  return REPORT_OPTIONAL_FORMATS[name].format(_escape(value))
+
+
+def _render_record(record):
+  """Return REPORT_RECORD_FORMAT string from passed `record`, i.e. an item of
+  the "records" part of the context used with `generate_report`. """
+  # Look up nested parts only once
+  row = record["row"]
+  policy_evaluated = row["policy_evaluated"]
+  identifiers = record["identifiers"]
+  auth_results = record["auth_results"]
+
+  return REPORT_RECORD_FORMAT.format_map({
+    "source_ip": _escape(row["source_ip"]),
+    "count": _escape(row["count"]),
+    "disposition": _escape(policy_evaluated["disposition"]),
+    "dkim": _escape(policy_evaluated["dkim"]),
+    "spf": _escape(policy_evaluated["spf"]),
+    "reasons": "".join(
+        REPORT_OPTIONAL_FORMATS["reason"].format(
+            type=_escape(reason["type"]),
+            comment=_render_optional("comment", reason.get("comment")))
+        for reason in policy_evaluated.get("reasons", [])),
+    "envelope_to": _render_optional("envelope_to",
+        identifiers.get("envelope_to")),
+    "header_from": _escape(identifiers["header_from"]),
+    "dkim_results": "".join(
+        REPORT_OPTIONAL_FORMATS["dkim_result"].format(
+            domain=_escape(dkim["domain"]), result=_escape(dkim["result"]),
+            human_result=_render_optional("human_result",
+                dkim.get("human_result")))
+        for dkim in auth_results.get("dkim", [])),
+    "spf_results": "".join(
+        REPORT_OPTIONAL_FORMATS["spf_result"].format(
+            domain=_escape(spf["domain"]), result=_escape(spf["result"]))
+        for spf in auth_results.get("spf", [])),
+  })
+
+
+def _render_report_header(context):
+  """Return REPORT_HEADER_FORMAT string from passed context used with
+  `generate_report`. """
+  report_metadata = context["report_metadata"]
+  date_range = report_metadata["date_range"]
+  policy_published = context["policy_published"]
+
+  return REPORT_HEADER_FORMAT.format_map({
+    "org_name": _escape(report_metadata["org_name"]),
+    "org_email": _escape(report_metadata["org_email"]),
+    "extra_contact_info": _render_optional("extra_contact_info",
+        report_metadata.get("extra_contact_info")),
+    "report_id": _escape(report_metadata["report_id"]),
+    "begin": _escape(date_range["begin"]),
+    "end": _escape(date_range["end"]),
+    "errors": "".join(REPORT_OPTIONAL_FORMATS["error"].format(_escape(error))
+        for error in report_metadata.get("errors", [])),
+    "domain": _escape(policy_published["domain"]),
+    "adkim": _render_optional("adkim", policy_published.get("adkim")),
+    "aspf": _render_optional("aspf", policy_published.get("aspf")),
+    "p": _escape(policy_published["p"]),
+    "sp": _escape(policy_published["sp"]),
+    "pct": _escape(policy_published["pct"]),
+  })
+
+
+def _render_report(context):
+  """Return DMARC aggregate report string from passed context used with
+  `generate_report`. """
+  return (_render_report_header(context) + "".join(_render_record(record)
+      for record in context["records"]) + REPORT_FOOTER)
 
 
 def generate_report(context):
@@ -81,11 +268,9 @@ def generate_report(context):
     report name corresponding to REPORT_FILENAME_FORMAT.
 
   """
-  # Render template using passed context
-  report_string = REPORT_TEMPLATE.render(context)
-
-  # Encode as `UTF-8` string (required e.g. by validate functions)
-  report_string = report_string.encode("utf-8")
+  # Render report string templates using passed context and encode as
+  # `UTF-8` string (required e.g. by validate functions)
+  report_string = _render_report(context).encode("utf-8")
 
   # Create report name
   report_name = _get_report_filename_from_context(context)
@@ -93,33 +278,187 @@ def generate_report(context):
   return report_string, report_name
 
 
+def generate_reports(contexts):
+  """
+  <Purpose>
+    Populate a DMARC aggregate report for each of the passed contexts (see
+    `generate_report`).
+
+  <Arguments>
+    contexts:
+            An iterable of python dictionaries containing DMARC aggregate
+            report data. (see data.sample_report for the required format)
+
+  <Returns>
+    A list of tuples as returned by `generate_report`, in the order of the
+    passed contexts.
+
+  """
+  return [generate_report(context) for context in contexts]
+
+
+def generate_reports_parallel(contexts, max_workers=None):
+  """
+  <Purpose>
+    Like `generate_reports`, but populate the reports in worker processes,
+    which pays off for large batches of contexts. The workers import this
+    module, including REPORT_SCHEMA, once at start-up.
+
+  <Arguments>
+    contexts:
+            An iterable of python dictionaries containing DMARC aggregate
+            report data. (see data.sample_report for the required format)
+
+    max_workers: (optional)
+            The maximum number of worker processes. Defaults to the number of
+            processors (see `concurrent.futures.ProcessPoolExecutor`).
+
+  <Returns>
+    A list of tuples as returned by `generate_report`, in the order of the
+    passed contexts.
+
+  """
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    # Send contexts to workers in chunks to amortize inter-process overhead
+    return list(executor.map(generate_report, contexts, chunksize=32))
+
+
+def generate_and_validate_report(context):
+  """
+  <Purpose>
+    Populate DMARC aggregate report based on passed context and validate it
+    using REPORT_SCHEMA. This is a shorthand for `generate_report` followed by
+    `validate_report`.
+
+  <Arguments>
+    context:
+            A python dictionary containing DMARC aggregate report data.
+            (see data.sample_report for the required format)
+
+  <Raises>
+    lxml.etree.XMLSyntaxError,
+            if the generated report can't be parsed, e.g. because the context
+            contains characters that are not allowed in XML.
+
+    lxml.etree.DocumentInvalid,
+            if the generated report is not valid against REPORT_SCHEMA.
+
+  <Returns>
+    A tuple containing the generated report as UTF-8 encoded string and the
+    report name corresponding to REPORT_FILENAME_FORMAT.
+
+  """
+  # Validating the parsed report is cheaper than building an element tree from
+  # the context in Python and validating that
+  report_string, report_name = generate_report(context)
+  validate_report(report_string)
+
+  return report_string, report_name
+
+
+def _validate_report_incrementally(dmarc_report):
+  """Validate passed UTF-8 encoded `dmarc_report` using REPORT_SCHEMA while
+  parsing it, discarding each record once it is parsed. See `validate_report`
+  for raised exceptions. """
+  try:
+    for _, record in etree.iterparse(io.BytesIO(dmarc_report),
+        tag="record", schema=REPORT_SCHEMA, **SAFE_PARSER_OPTIONS):
+      # Release the record and any preceding siblings, which would otherwise
+      # still be referenced by the root element
+      record.clear(keep_tail=True)
+      while record.getprevious() is not None:
+        del record.getparent()[0]
+
+  # Validating while parsing reports schema violations as syntax errors,
+  # re-raise them like `XMLSchema.assertValid` does
+  except etree.XMLSyntaxError as e:
+    if (etree.ErrorTypes.SCHEMAV_NOROOT <= e.code
+        <= etree.ErrorTypes.SCHEMAV_MISC):
+      raise etree.DocumentInvalid(str(e)) from e
+
+    raise
+
+
+def write_report(context, fileobj):
+  """
+  <Purpose>
+    Populate DMARC aggregate report based on passed context and write it to
+    passed file object. Other than `generate_report`, the report is never
+    materialized as a whole, instead each record is rendered and written at a
+    time, which keeps memory use independent of the number of records. The
+    written report is byte-identical to the one returned by `generate_report`.
+
+  <Arguments>
+    context:
+            A python dictionary containing DMARC aggregate report data.
+            (see data.sample_report for the required format)
+
+    fileobj:
+            A file object opened for writing in binary mode, or a file path.
+
+  <Returns>
+    The report name corresponding to REPORT_FILENAME_FORMAT.
+
+  """
+  if isinstance(fileobj, (str, os.PathLike)):
+    with open(fileobj, "wb") as f:
+      return write_report(context, f)
+
+  fileobj.write(_render_report_header(context).encode("utf-8"))
+  for record in context["records"]:
+    fileobj.write(_render_record(record).encode("utf-8"))
+  fileobj.write(REPORT_FOOTER.encode("utf-8"))
+
+  return _get_report_filename_from_context(context)
+
+
 def validate_report(dmarc_report):
   """
   <Purpose>
-    Validate passed DMARC report using REPORT_SCHEMA.
+    Validate passed DMARC report using the pre-compiled REPORT_SCHEMA.
 
   <Arguments>
     dmarc_report:
-            UTF-8 encoded DMARC aggregate report data.
+            UTF-8 encoded DMARC aggregate report data, or an already parsed
+            or built lxml element (tree), which is validated without
+            serializing and re-parsing it. Report data larger than
+            INCREMENTAL_VALIDATION_MIN_SIZE is validated while parsing.
 
   <Raises>
-    ParseError,
-            if xml_data can' be parsed.
+    lxml.etree.XMLSyntaxError,
+            if dmarc_report can't be parsed.
 
-    InvalidDocument,
-            if xml_data is not valid against xsd_data.
+    lxml.etree.DocumentInvalid,
+            if dmarc_report is not valid against REPORT_SCHEMA.
 
   <Returns>
     None.
   """
-  validate(dmarc_report, REPORT_SCHEMA)
+  if (etree.iselement(dmarc_report) or
+      isinstance(dmarc_report, etree._ElementTree)):
+    REPORT_SCHEMA.assertValid(dmarc_report)
+
+  elif len(dmarc_report) >= INCREMENTAL_VALIDATION_MIN_SIZE:
+    _validate_report_incrementally(dmarc_report)
+
+  else:
+    REPORT_SCHEMA.assertValid(
+        etree.fromstring(dmarc_report, _get_safe_parser()))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_schema(xsd_data):
+  """Return schema object compiled from passed `xsd_data`. Memoized for a few
+  schemas, as `validate` is usually called with the same xsd data. """
+  return etree.XMLSchema(etree.fromstring(xsd_data, _get_safe_parser()))
 
 
 def validate(xml_data, xsd_data):
   """
   <Purpose>
     Validate passed xml data against xsd data and raise Exception
-    if data is invalid.
+    if data is invalid. Compiled schemas are cached for the most recently
+    used xsd data, use `validate_report` to validate DMARC aggregate reports.
 
   <Arguments>
     xml_data:
@@ -129,25 +468,24 @@ def validate(xml_data, xsd_data):
             UTF-8 encoded XSD schema used for validation.
 
   <Raises>
-    ParseError,
-            if xml_data can' be parsed.
+    lxml.etree.XMLSyntaxError,
+            if xml_data or xsd_data can't be parsed.
 
-    XMLSchemaParseError,
-            if xsd_data can't be parsed.
+    lxml.etree.XMLSchemaParseError,
+            if xsd_data is not a valid schema.
 
-    InvalidDocument,
+    lxml.etree.DocumentInvalid,
             if xml_data is not valid against xsd_data.
 
   <Returns>
     None.
 
   """
-  # Create XML objects from xml and xsd data
-  xml = etree.fromstring(xml_data)
-  schema_xml = etree.fromstring(xsd_data)
+  # Create XML object from xml data
+  xml = etree.fromstring(xml_data, _get_safe_parser())
 
-  # Create a schema object from schema xml object
-  schema = etree.XMLSchema(schema_xml)
+  # Get (cached) schema object for xsd data
+  schema = _get_schema(xsd_data)
 
   # Validate
   schema.assertValid(xml)
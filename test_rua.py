@@ -0,0 +1,205 @@
+"""
+<Name>
+  test_rua.py
+
+<Author>
+  Lukas Puehringer <luk.puehringer@gmail.com>
+
+<Started>
+  October, 2026
+
+<Copyright>
+  See LICENSE for licensing information.
+
+<Purpose>
+  Check that the report string templates used by `rua.generate_report` and
+  `rua.write_report` produce the same report as serializing an element tree
+  built from the same context with lxml, and that the reports are valid. Run
+  from the repo root with `python -m unittest test_rua`.
+
+"""
+import copy
+import io
+import unittest
+
+from lxml import etree
+
+import rua
+from data import sample_report
+
+
+def _add_element(parent, tag, value):
+  """Append element with passed `tag` and `value` as text to `parent`. """
+  etree.SubElement(parent, tag).text = str(value)
+
+
+def _build_report_metadata(report_metadata):
+  """Create "report_metadata" element from passed `report_metadata` part of
+  the context used with `rua.generate_report`. """
+  element = etree.Element("report_metadata")
+  _add_element(element, "org_name", report_metadata["org_name"])
+  _add_element(element, "email", report_metadata["org_email"])
+  if report_metadata.get("extra_contact_info"):
+    _add_element(element, "extra_contact_info",
+        report_metadata["extra_contact_info"])
+  _add_element(element, "report_id", report_metadata["report_id"])
+
+  date_range = report_metadata["date_range"]
+  date_range_element = etree.SubElement(element, "date_range")
+  _add_element(date_range_element, "begin", date_range["begin"])
+  _add_element(date_range_element, "end", date_range["end"])
+
+  for error in report_metadata.get("errors", []):
+    _add_element(element, "error", error)
+
+  return element
+
+
+def _build_policy_published(policy_published):
+  """Create "policy_published" element from passed `policy_published` part of
+  the context used with `rua.generate_report`. """
+  element = etree.Element("policy_published")
+  _add_element(element, "domain", policy_published["domain"])
+  if policy_published.get("adkim"):
+    _add_element(element, "adkim", policy_published["adkim"])
+  if policy_published.get("aspf"):
+    _add_element(element, "aspf", policy_published["aspf"])
+  _add_element(element, "p", policy_published["p"])
+  _add_element(element, "sp", policy_published["sp"])
+  _add_element(element, "pct", policy_published["pct"])
+
+  return element
+
+
+def _build_record(record):
+  """Create "record" element from passed `record`, i.e. an item of the
+  "records" part of the context used with `rua.generate_report`. """
+  # Look up nested parts only once
+  row = record["row"]
+  policy_evaluated = row["policy_evaluated"]
+  identifiers = record["identifiers"]
+  auth_results = record["auth_results"]
+
+  element = etree.Element("record")
+
+  row_element = etree.SubElement(element, "row")
+  _add_element(row_element, "source_ip", row["source_ip"])
+  _add_element(row_element, "count", row["count"])
+
+  policy_evaluated_element = etree.SubElement(row_element, "policy_evaluated")
+  _add_element(policy_evaluated_element, "disposition",
+      policy_evaluated["disposition"])
+  _add_element(policy_evaluated_element, "dkim", policy_evaluated["dkim"])
+  _add_element(policy_evaluated_element, "spf", policy_evaluated["spf"])
+  for reason in policy_evaluated.get("reasons", []):
+    reason_element = etree.SubElement(policy_evaluated_element, "reason")
+    _add_element(reason_element, "type", reason["type"])
+    if reason.get("comment"):
+      _add_element(reason_element, "comment", reason["comment"])
+
+  identifiers_element = etree.SubElement(element, "identifiers")
+  if identifiers.get("envelope_to"):
+    _add_element(identifiers_element, "envelope_to",
+        identifiers["envelope_to"])
+  _add_element(identifiers_element, "header_from", identifiers["header_from"])
+
+  auth_results_element = etree.SubElement(element, "auth_results")
+  for dkim in auth_results.get("dkim", []):
+    dkim_element = etree.SubElement(auth_results_element, "dkim")
+    _add_element(dkim_element, "domain", dkim["domain"])
+    _add_element(dkim_element, "result", dkim["result"])
+    if dkim.get("human_result"):
+      _add_element(dkim_element, "human_result", dkim["human_result"])
+  for spf in auth_results.get("spf", []):
+    spf_element = etree.SubElement(auth_results_element, "spf")
+    _add_element(spf_element, "domain", spf["domain"])
+    _add_element(spf_element, "result", spf["result"])
+
+  return element
+
+
+def _build_report_tree(context):
+  """Create DMARC aggregate report "feedback" element tree from passed
+  context used with `rua.generate_report`. """
+  root = etree.Element("feedback")
+  root.append(_build_report_metadata(context["report_metadata"]))
+  root.append(_build_policy_published(context["policy_published"]))
+  for record in context["records"]:
+    root.append(_build_record(record))
+
+  return root
+
+
+def _get_edge_case_contexts():
+  """Return a list of contexts, each a variant of the sample report with
+  empty, falsy or special values that the report templates must handle like
+  lxml does. """
+  contexts = []
+
+  # Empty errors are still rendered, multiple records
+  context = copy.deepcopy(sample_report)
+  context["report_metadata"]["errors"] = ["", "some error", 0]
+  context["records"] = context["records"] * 3
+  contexts.append(context)
+
+  # Characters that need to be escaped
+  context = copy.deepcopy(sample_report)
+  context["report_metadata"]["org_name"] = "a&b<c>d\"'"
+  context["report_metadata"]["errors"] = ["carriage\rreturn", "]]>"]
+  context["records"][0]["row"]["policy_evaluated"]["reasons"] = [
+      {"type": "other", "comment": "line\r\nbreak & <more>"}]
+  contexts.append(context)
+
+  # Falsy optional values are left out
+  context = copy.deepcopy(sample_report)
+  context["report_metadata"]["extra_contact_info"] = ""
+  context["policy_published"]["adkim"] = None
+  context["policy_published"]["aspf"] = ""
+  record = context["records"][0]
+  record["row"]["count"] = 0
+  record["row"]["policy_evaluated"]["reasons"] = [
+      {"type": "other", "comment": ""}, {"type": "local_policy"}]
+  record["identifiers"]["envelope_to"] = ""
+  record["auth_results"]["dkim"] = [
+      {"domain": "example.org", "result": "pass", "human_result": ""},
+      {"domain": "example.com", "result": "fail", "human_result": "failed"}]
+  contexts.append(context)
+
+  # Optional lists are missing altogether
+  context = copy.deepcopy(sample_report)
+  del context["report_metadata"]["errors"]
+  del context["records"][0]["row"]["policy_evaluated"]["reasons"]
+  del context["records"][0]["auth_results"]["dkim"]
+  contexts.append(context)
+
+  return contexts
+
+
+class TestReportTemplates(unittest.TestCase):
+  def test_templates_match_element_tree(self):
+    for context in [sample_report] + _get_edge_case_contexts():
+      report_tree = _build_report_tree(context)
+      expected = etree.tostring(report_tree, encoding="utf-8",
+          xml_declaration=True, pretty_print=True)
+
+      report, _ = rua.generate_report(context)
+      self.assertEqual(report, expected)
+
+      report_file = io.BytesIO()
+      rua.write_report(context, report_file)
+      self.assertEqual(report_file.getvalue(), expected)
+
+
+  def test_generate_and_validate_report(self):
+    report, report_name = rua.generate_and_validate_report(sample_report)
+    self.assertEqual((report, report_name),
+        rua.generate_report(sample_report))
+
+    context = copy.deepcopy(sample_report)
+    context["policy_published"]["p"] = "invalid"
+    with self.assertRaises(etree.DocumentInvalid):
+      rua.generate_and_validate_report(context)
+
+
+if __name__ == "__main__":
+  unittest.main()